@@ -1,28 +1,130 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
+import time
 from contextlib import ExitStack
 
 import subprocess
 
 from odoo import fields, models
+from .project import QUEUE_STATS, GitTrace, Stages, _fetch, _process_stats, push
 
 
 _logger = logging.getLogger(__name__)
+_stats_logger = _logger.getChild('stats')
 
+# how long (in seconds) a worker gets to process an item it claimed before
+# other workers consider it dead and the item up for grabs
+DEFAULT_LEASE = 3600
 class Queue:
-    def _process_item(self):
+    # items with the same value for this field are processed one at a time,
+    # in order
+    _serialize_on = None
+
+    def _process_item(self, stages):
+        """
+        :param Stages stages: records the time spent in the various stages
+                              of processing the item
+        """
         raise NotImplementedError
 
     def _process(self):
+        depth, oldest = self._queue_status()
+        if depth:
+            _stats_logger.info(json.dumps({
+                'queue': self._name,
+                'depth': depth,
+                'oldest': oldest,
+            }))
         while True:
-            b = self.search([], limit=1)
+            b = self._claim()
             if not b:
                 return
 
-            b._process_item()
+            item = b.id
+            stages = Stages()
+            start = time.time()
+            try:
+                b._process_item(stages)
+            except Exception:
+                # release the item so the next run can retry it right away
+                # rather than wait for the lease to expire
+                self.env.cr.rollback()
+                b.lease_until = False
+                self.env.cr.commit()
+                self._record(item, stages, time.time() - start, failed=True)
+                raise
 
             b.unlink()
             self.env.cr.commit()
+            self._record(item, stages, time.time() - start)
+
+    def _queue_status(self):
+        """ Returns the number of items in the queue and the age (in seconds)
+        of the oldest one, to keep an eye on forward-port lag.
+        """
+        self.env.cr.execute("""
+        SELECT count(*), extract(epoch from (now() at time zone 'UTC') - min(create_date))
+        FROM {table}
+        """.format(table=self._table))
+        depth, oldest = self.env.cr.fetchone()
+        return depth, int(oldest or 0)
+
+    def _record(self, item, stages, elapsed, failed=False):
+        summary = stages.summary()
+        stats = QUEUE_STATS[self._name]
+        stats['items'] += 1
+        stats['failures'] += failed
+        stats['time'] += elapsed
+        for stage, s in summary.items():
+            stats[stage] += s['time']
+        _stats_logger.info(json.dumps({
+            'queue': self._name,
+            'item': item,
+            'failed': failed,
+            'time': round(elapsed, 3),
+            'stages': summary,
+            'process': _process_stats(),
+        }))
+
+    def _claim(self):
+        """ Claims the oldest item which is not being processed by an other
+        worker, and commits the claim so it's visible to other workers.
+
+        Items are leased rather than just row-locked as processing commits
+        (possibly several times), which would release a row lock while the
+        item is still being worked on. ``SKIP LOCKED`` only avoids workers
+        blocking on one another during the claim itself.
+
+        If the queue is serialized (``_serialize_on``), only the oldest item
+        of each series can be claimed.
+        """
+        lease = int(self.env['ir.config_parameter'].sudo().get_param(
+            'forwardport.lease_duration', DEFAULT_LEASE))
+        serialize = ''
+        if self._serialize_on:
+            serialize = """
+            AND NOT EXISTS (
+                SELECT 1 FROM {table} o
+                WHERE o.{field} = q.{field} AND o.id < q.id
+            )
+            """.format(table=self._table, field=self._serialize_on)
+        self.env.cr.execute("""
+        UPDATE {table} SET lease_until = (now() at time zone 'UTC') + %s * interval '1 second'
+        WHERE id = (
+            SELECT id FROM {table} q
+            WHERE (lease_until IS NULL OR lease_until < (now() at time zone 'UTC'))
+            {serialize}
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+        """.format(table=self._table, serialize=serialize), [lease])
+        ids = [id_ for id_, in self.env.cr.fetchall()]
+        self.env.cr.commit()
+        self.invalidate_cache(['lease_until'], ids)
+        return self.browse(ids)
 
 
 class BatchQueue(models.Model, Queue):
@@ -34,8 +136,9 @@ class BatchQueue(models.Model, Queue):
         ('merge', 'Merge'),
         ('fp', 'Forward Port Followup'),
     ], required=True)
+    lease_until = fields.Datetime(help="the item is being processed by a worker until then")
 
-    def _process_item(self):
+    def _process_item(self, stages):
         batch = self.batch_id
 
         # only some prs of the batch have a parent, that's weird
@@ -43,7 +146,7 @@ class BatchQueue(models.Model, Queue):
         if with_parent and with_parent != batch.prs:
             _logger.warn("Found a subset of batch %s (%s) with parents: %s, should probably investigate (normally either they're all parented or none are)", batch, batch.prs, with_parent)
 
-        newbatch = batch.prs._port_forward()
+        newbatch = batch.prs._port_forward(stages)
         if newbatch:
             _logger.info(
                 "Processing %s (from %s): %s (%s) -> %s (%s)",
@@ -63,29 +166,58 @@ class BatchQueue(models.Model, Queue):
 class UpdateQueue(models.Model, Queue):
     _name = 'forwardport.updates'
     _description = 'if a forward-port PR gets updated & has followups (cherrypick succeeded) the followups need to be updated as well'
+    # updates of the same chain push the same branches
+    _serialize_on = 'original_root'
 
     original_root = fields.Many2one('runbot_merge.pull_requests')
     new_root = fields.Many2one('runbot_merge.pull_requests')
+    lease_until = fields.Datetime(help="the item is being processed by a worker until then")
+
+    def _process_item(self, stages):
+        with stages('chain'):
+            descendants = list(self.new_root._iter_descendants())
+        if not descendants:
+            return
 
-    def _process_item(self):
         previous = self.new_root
+        # remote -> (repository, refspecs), so the whole chain is pushed at once
+        pushes = {}
+        # all the steps of the chain share a working copy, if they need one
+        workspace = {}
+        trace = GitTrace('%s followups' % self.new_root.display_name)
         with ExitStack() as s:
-            for child in self.new_root._iter_descendants():
+            source = s.enter_context(self.new_root._get_local_directory().persistent().traced(trace))
+            # update the cache once for the entire chain
+            targets = self.env['runbot_merge.branch']
+            for child in descendants:
+                targets |= child.target
+            with stages('fetch'):
+                _fetch(source, *self.new_root._fetch_spec(targets))
+
+            for child in descendants:
+                with stages('chain'):
+                    job = previous._forward_port_job(
+                        source, child.target, child.refname,
+                        workspace=workspace, stages=stages,
+                    )
                 # QUESTION: update PR to draft if there are conflicts?
-                _, working_copy = previous._create_fp_branch(
-                    child.target, child.refname, s)
+                _, repo, new_head = job.run(s)
 
-                new_head = working_copy.stdout().rev_parse(child.refname).stdout.decode().strip()
                 # update child's head to the head we're going to push
                 child.with_context(ignore_head_update=True).head = new_head
-                working_copy.push('-f', 'target', child.refname)
-                # committing here means github could technically trigger its
-                # webhook before sending a response, but committing before
-                # would mean we can update the PR in database but fail to
-                # update on github, which is probably worse?
-                # alternatively we can commit, push, and rollback if the push
-                # fails
-                # FIXME: handle failures (especially on non-first update)
-                self.env.cr.commit()
+                remote = child.repository._fp_remote_url()
+                pushes.setdefault(remote, (repo, []))[1].append(
+                    '%s:refs/heads/%s' % (new_head, child.refname))
 
                 previous = child
+
+            # the head updates are only committed after the push: github
+            # could technically trigger its webhook before sending a
+            # response, but committing before would mean we can update the
+            # PRs in database but fail to update on github, which is
+            # probably worse? As the push is atomic, if it fails none of the
+            # PRs are updated on github and the updates are rolled back.
+            with stages('push'):
+                for remote, (repo, refspecs) in pushes.items():
+                    push(repo, remote, refspecs, force=True)
+        _logger.info("Updated %s, git: %s", trace.label, trace.summary())
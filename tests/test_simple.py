@@ -553,6 +553,48 @@ def test_conflict_deleted(env, config, make_repo):
     }
     assert pr1.state == 'opened', "state should be open still"
 
+def test_conflict_squash_clean(env, config, make_repo):
+    """ If the commits of a PR conflict individually but the PR as a whole
+    applies cleanly (e.g. a later commit fixes the conflict), the port should
+    still be flagged as failed rather than blow up
+    """
+    prod, other = make_basic(env, config, make_repo)
+    b_g = prod.read_tree(prod.commit('b'))['g']
+    # p_0 conflicts with g on b, but p_1 brings g in line with b
+    with prod:
+        [_, p_1] = prod.make_commits(
+            'a',
+            Commit('p_0', tree={'g': 'xxx', 'i': '1'}),
+            Commit('p_1', tree={'g': b_g}),
+            ref='heads/conflicting'
+        )
+        pr = prod.make_pr(target='a', head='conflicting')
+        prod.post_status(p_1, 'success', 'legal/cla')
+        prod.post_status(p_1, 'success', 'ci/runbot')
+        pr.post_comment('hansen r+ rebase-ff', config['role_reviewer']['token'])
+
+    env.run_crons()
+    with prod:
+        prod.post_status('staging.a', 'success', 'legal/cla')
+        prod.post_status('staging.a', 'success', 'ci/runbot')
+
+    env.run_crons()
+    # wait a bit for PR webhook... ?
+    time.sleep(5)
+    env.run_crons()
+
+    pr0, pr1 = env['runbot_merge.pull_requests'].search([], order='number')
+    # failed cherrypick so not linked to its parent
+    assert not pr1.parent_id
+    assert pr1.source_id == pr0
+    assert pr1.state == 'opened'
+    # the squashed PR applied without conflict markers
+    assert prod.read_tree(prod.commit(pr1.head)) == {
+        **prod.read_tree(prod.commit('b')),
+        'i': '1',
+    }
+    assert prod.commit(pr1.head).message.startswith('Cherry pick of ')
+
 def test_empty(env, config, make_repo, users):
     """ Cherrypick of an already cherrypicked (or separately implemented)
     commit -> create draft PR.
@@ -863,6 +905,49 @@ More info at https://github.com/odoo/odoo/wiki/Mergebot#forward-port
 """ % (users['user'], users['reviewer'], users['user'])),
     ]
 
+def test_sequence_change(env, config, make_repo):
+    """ The forward-port sequence is cached, changing the sequence or
+    disabling a branch should be reflected in both the default limit and the
+    forward-port targets
+    """
+    prod, other = make_basic(env, config, make_repo)
+    Branches = env['runbot_merge.branch']
+    PRs = env['runbot_merge.pull_requests']
+    branch_b = Branches.search([('name', '=', 'b')])
+    branch_c = Branches.search([('name', '=', 'c')])
+
+    with prod:
+        prod.make_commits('a', Commit('c 0', tree={'0': '0'}), ref='heads/branch0')
+        pr0 = prod.make_pr(target='a', head='branch0')
+    env.run_crons()
+    assert PRs.search([('number', '=', pr0.number)]).limit_id == branch_c
+
+    # move b to the end of the sequence: a -> c -> b
+    branch_b.fp_sequence = -1
+    with prod:
+        [c] = prod.make_commits('a', Commit('c 1', tree={'1': '1'}), ref='heads/branch1')
+        pr1 = prod.make_pr(target='a', head='branch1')
+        prod.post_status(c, 'success', 'legal/cla')
+        prod.post_status(c, 'success', 'ci/runbot')
+        pr1.post_comment('hansen r+', config['role_reviewer']['token'])
+    env.run_crons()
+    pr1_id = PRs.search([('number', '=', pr1.number)])
+    assert pr1_id.limit_id == branch_b
+
+    with prod:
+        prod.post_status('staging.a', 'success', 'legal/cla')
+        prod.post_status('staging.a', 'success', 'ci/runbot')
+    env.run_crons()
+    fp = PRs.search([('parent_id', '=', pr1_id.id)])
+    assert fp.target == branch_c
+
+    branch_b.active = False
+    with prod:
+        prod.make_commits('a', Commit('c 2', tree={'2': '2'}), ref='heads/branch2')
+        pr2 = prod.make_pr(target='a', head='branch2')
+    env.run_crons()
+    assert PRs.search([('number', '=', pr2.number)]).limit_id == branch_c
+
 # reviewer = of the FP sequence, the original PR is always reviewed by `user`
 # set as reviewer
 Case = collections.namedtuple('Case', 'author reviewer delegate success')
@@ -1149,6 +1234,44 @@ More info at https://github.com/odoo/odoo/wiki/Mergebot#forward-port
         assert not pr1_1.parent_id
         assert pr2_1.state == 'opened'
 
+def test_queue_claim(env, config, make_repo):
+    """ Queue items being processed (leased) should be skipped, and the
+    updates of a chain should be processed one at a time
+    """
+    prod, other = make_basic(env, config, make_repo)
+    with prod:
+        prod.make_commits('a', Commit('p_0', tree={'x': '0'}), ref='heads/change')
+        prod.make_pr(target='a', head='change')
+    env.run_crons()
+    [pr] = env['runbot_merge.pull_requests'].search([])
+    [a] = env['runbot_merge.branch'].search([('name', '=', 'a')])
+    leased = (datetime.utcnow() + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+
+    Batches = env['forwardport.batches']
+    b1 = Batches.create({
+        'batch_id': env['runbot_merge.batch'].create({'target': a.id}).id,
+        'source': 'merge',
+        'lease_until': leased,
+    })
+    b2 = Batches.create({
+        'batch_id': env['runbot_merge.batch'].create({'target': a.id}).id,
+        'source': 'merge',
+    })
+    env.run_crons('forwardport.port_forward')
+    assert not Batches.search([('id', '=', b2.id)]), "the free item should have been processed"
+    assert Batches.search([]) == b1, "the leased item should have been skipped"
+
+    Updates = env['forwardport.updates']
+    u1 = Updates.create({'original_root': pr.id, 'new_root': pr.id, 'lease_until': leased})
+    u2 = Updates.create({'original_root': pr.id, 'new_root': pr.id})
+    env.run_crons('forwardport.updates')
+    assert Updates.search([]) == u1 | u2, \
+        "the second update of the chain should wait for the first"
+
+    u1.write({'lease_until': False})
+    env.run_crons('forwardport.updates')
+    assert not Updates.search([])
+
 def sPeNgBaB(s):
     return ''.join(
         l if i % 2 == 0 else l.upper()